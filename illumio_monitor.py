@@ -9,7 +9,9 @@ Illumio API Monitor (繁體中文版)
 
 import sys
 import os
+import re
 import json
+import copy
 import requests
 import smtplib
 import datetime
@@ -17,21 +19,51 @@ import argparse
 import readline
 import logging
 import time
+import random
+import threading
 import gzip
-from io import BytesIO
+import zlib
+import stat
+import tempfile
+import html
+import functools
+import contextlib
+from io import BytesIO, TextIOWrapper
+from string import Template
 from logging.handlers import RotatingFileHandler
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
+from email.message import EmailMessage
 from collections import Counter
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
-from requests.packages.urllib3.exceptions import InsecureRequestWarning
+from requests.packages.urllib3.exceptions import InsecureRequestWarning, NewConnectionError
+
+try:
+    import orjson  # 選用套件：若已安裝則以 C 實作加速大量事件/流量的 JSON 編解碼
+except ImportError:
+    orjson = None
 
 # 禁用 SSL 警告 (針對使用自簽憑證的 PCE 環境)
 requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
 
+# API 資料的 JSON 編解碼 (設定檔仍使用標準 json 以保留縮排可讀性)
+if orjson:
+    _json_loads = orjson.loads
+    def _json_dumps(obj, pretty=False):
+        return orjson.dumps(obj, default=str, option=orjson.OPT_INDENT_2 if pretty else 0).decode('utf-8')
+else:
+    _json_loads = json.loads
+    def _json_dumps(obj, pretty=False):
+        # 與 orjson 輸出一致：緊湊分隔符、非 ASCII 字元原樣保留
+        if pretty: return json.dumps(obj, indent=2, default=str, ensure_ascii=False)
+        return json.dumps(obj, separators=(',', ':'), default=str, ensure_ascii=False)
+
 # ================= 設定與常數 =================
 CONFIG_FILE = "illumio_api_config.json"
 STATE_FILE = "illumio_api_state.json"
+# 歷史紀錄可接受的時間格式 (本程式寫入的格式，以及 PCE 帶毫秒的格式)
+TS_FORMATS = ('%Y-%m-%dT%H:%M:%SZ', '%Y-%m-%dT%H:%M:%S.%fZ')
 
 # Log 設定
 LOG_DIR = "logs"
@@ -40,6 +72,15 @@ TRAFFIC_LOG_FILE = os.path.join(LOG_DIR, "illumio_traffic.log")
 MAX_LOG_SIZE = 10 * 1024 * 1024  # 10 MB
 BACKUP_COUNT = 5                 # 保留 5 份備份日誌
 
+# HTTP 重試設定 (針對 PCE 限流 429 與暫時性 5xx 錯誤)
+HTTP_TIMEOUT = 30                # 未指定 timeout 時的預設秒數
+HTTP_MAX_RETRIES = 3             # 首次請求失敗後最多重試次數
+HTTP_BACKOFF_BASE = 1.0          # 指數退避基準秒數 (1, 2, 4...)
+HTTP_MAX_BACKOFF = 60            # 單次等待上限秒數
+HTTP_RETRY_STATUS = (429, 500, 502, 503, 504)
+# 非冪等請求 (如提交 async query 的 POST) 只在 429 或請求尚未送出的連線失敗時重試，避免重複建立 Job
+HTTP_IDEMPOTENT_METHODS = frozenset(('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'))
+
 class Colors:
     HEADER = '\033[95m'
     BLUE = '\033[94m'
@@ -49,6 +90,13 @@ class Colors:
     FAIL = '\033[91m'
     ENDC = '\033[0m'
 
+_EMPTY = {}  # 巢狀 dict 查找時使用的唯讀預設值，請勿修改
+
+# 清除畫面用的 ANSI 序列 (直接輸出，免去每次重繪 fork shell 執行 clear/cls)
+_IS_WIN = os.name == 'nt'
+_CLEAR = '\033[2J\033[H'
+_ansi_clear = None  # 首次清除畫面時判定主控台是否支援 ANSI
+
 # ================= 事件範本 (預設監控規則) =================
 EVENT_TEMPLATES = {
     "安全性與威脅 (Security)": [
@@ -121,8 +169,139 @@ EVENT_TEMPLATES = {
     ]
 }
 
+# ================= 郵件範本 =================
+# 範本於載入時編譯一次；send_email 只做代入，動態內容皆先經 html.escape 處理
+HEALTH_ROW_HTML = Template("""
+                <tr>
+                    <td style="padding:10px; border-bottom:1px solid #eee; font-weight:bold;">$time</td>
+                    <td style="padding:10px; border-bottom:1px solid #eee; color:#dc3545; font-weight:bold;">$status</td>
+                    <td style="padding:10px; border-bottom:1px solid #eee; font-family:monospace; font-size:12px;">$details</td>
+                </tr>
+                """)
+
+HEALTH_SECTION_HTML = Template("""
+            <h3 style="background:#dc3545; color:white; padding:10px; margin-top:20px;">🚨 PCE 服務健康狀態異常 (Service Health Alert)</h3>
+            <div style="padding:10px; background:#fff3f3; border:1px solid #dc3545; color:#dc3545; margin-bottom:15px;">
+                <strong>警告：</strong> 無法連線至 PCE API ($url)，請立即檢查系統狀態。
+            </div>
+            <table style="width:100%; border-collapse:collapse; font-family:Arial, sans-serif;">
+                <tr style="background:#f7f7f7;">
+                    <th style="text-align:left; padding:8px;">時間 (UTC)</th>
+                    <th style="text-align:left; padding:8px;">狀態 (Status)</th>
+                    <th style="text-align:left; padding:8px;">錯誤詳情 (Details)</th>
+                </tr>
+                $rows
+            </table>
+            """)
+
+EVENT_ROW_HTML = Template("""
+                <tr>
+                    <td style="padding:8px; border-bottom:1px solid #eee;">$time</td>
+                    <td style="padding:8px; border-bottom:1px solid #eee;">$rule</td>
+                    <td style="padding:8px; border-bottom:1px solid #eee; color:$sev_color; font-weight:bold;">$severity ($count)</td>
+                    <td style="padding:8px; border-bottom:1px solid #eee;">$source</td>
+                    <td style="padding:8px; border-bottom:1px solid #eee; font-size:12px;">
+                        <div>$desc</div>
+                        <div style="color:#666;">Type: $raw_type</div>
+                        <div style="color:#0056b3;"><strong>建議:</strong> $rec</div>
+                    </td>
+                </tr>
+                <tr>
+                    <td colspan="5" style="padding:10px; background:#f8f9fa; border-bottom:1px solid #eee;">
+                        <div style="font-size:11px; color:#555; font-family:monospace; margin-bottom:5px;"><strong>原始日誌快照 (Raw Log Snapshot):</strong></div>
+                        <pre style="margin:0; font-size:10px; color:#333; white-space:pre-wrap; background:#eee; padding:5px;">$raw</pre>
+                    </td>
+                </tr>
+                """)
+
+EVENT_SECTION_HTML = Template("""
+            <h3 style="background:#f0ad4e; color:white; padding:10px; margin-top:20px;">安全性與系統事件 (Security Events)</h3>
+            <table style="width:100%; border-collapse:collapse; font-family:Arial, sans-serif;">
+                <tr style="background:#f7f7f7;">
+                    <th style="text-align:left; padding:8px;">時間</th>
+                    <th style="text-align:left; padding:8px;">規則</th>
+                    <th style="text-align:left; padding:8px;">嚴重性 (次數)</th>
+                    <th style="text-align:left; padding:8px;">來源</th>
+                    <th style="text-align:left; padding:8px;">詳細資訊與建議</th>
+                </tr>
+                $rows
+            </table>
+            """)
+
+TRAFFIC_ROW_HTML = Template("""
+                <tr>
+                    <td style="padding:8px; border-bottom:1px solid #eee; font-weight:bold; color:#d9534f;">$count</td>
+                    <td style="padding:8px; border-bottom:1px solid #eee;">$rule</td>
+                    <td style="padding:8px; border-bottom:1px solid #eee; font-size:12px;">$details</td>
+                    <td style="padding:8px; border-bottom:1px solid #eee; font-size:12px; color:#0056b3;">
+                        $rec
+                    </td>
+                </tr>
+                <tr>
+                    <td colspan="4" style="padding:10px; background:#f8f9fa; border-bottom:1px solid #eee;">
+                        <div style="font-size:11px; color:#555; font-family:monospace; margin-bottom:5px;"><strong>原始日誌快照 (Raw Log Snapshot):</strong></div>
+                        <pre style="margin:0; font-size:10px; color:#333; white-space:pre-wrap; background:#eee; padding:5px;">$raw</pre>
+                    </td>
+                </tr>
+                """)
+
+TRAFFIC_SECTION_HTML = Template("""
+            <h3 style="background:#17a2b8; color:white; padding:10px; margin-top:20px;">流量異常 (Traffic Anomalies)</h3>
+            <table style="width:100%; border-collapse:collapse; font-family:Arial, sans-serif;">
+                <tr style="background:#f7f7f7;">
+                    <th style="text-align:left; padding:8px;">累積次數</th>
+                    <th style="text-align:left; padding:8px;">規則</th>
+                    <th style="text-align:left; padding:8px;">前 5 名流量來源 (Top Talkers)</th>
+                    <th style="text-align:left; padding:8px;">建議措施</th>
+                </tr>
+                $rows
+            </table>
+            """)
+
+REPORT_HTML = Template("""
+        <html>
+        <body style="font-family: Arial, sans-serif; color:#333;">
+            <div style="max-width:900px; margin:auto; border:1px solid #ddd; padding:20px;">
+                <h2 style="color:#2c3e50; text-align:center;">Illumio API 監控報告</h2>
+                <div style="text-align:center; color:#777; font-size:12px; margin-bottom:20px;">
+                    Org ID: $org_id | 產生時間: $now
+                </div>
+                $health_html
+                $event_html
+                $traffic_html
+                <div style="margin-top:30px; font-size:11px; color:#999; text-align:center; border-top:1px solid #eee; padding-top:10px;">
+                    這是自動產生的郵件，請登入 PCE Console 查看完整日誌。
+                </div>
+            </div>
+        </body>
+        </html>
+        """)
+
 # ================= 輸入輔助函式 =================
+def _enable_windows_vt():
+    # Windows 10 以上可開啟主控台的 VT 模式，讓 ANSI 序列 (含 Colors 色碼) 直接生效
+    try:
+        import ctypes
+        kernel32 = ctypes.windll.kernel32
+        handle = kernel32.GetStdHandle(-11)  # STD_OUTPUT_HANDLE
+        mode = ctypes.c_uint32()
+        if not kernel32.GetConsoleMode(handle, ctypes.byref(mode)): return False
+        return bool(kernel32.SetConsoleMode(handle, mode.value | 0x0004))  # ENABLE_VIRTUAL_TERMINAL_PROCESSING
+    except Exception:
+        return False
+
+def clear_screen():
+    global _ansi_clear
+    if _ansi_clear is None:
+        _ansi_clear = not _IS_WIN or _enable_windows_vt()
+    if _ansi_clear:
+        sys.stdout.write(_CLEAR)
+        sys.stdout.flush()
+    else:
+        os.system('cls')
+
 def safe_input(prompt, value_type=str, valid_range=None, allow_cancel=True):
+    # valid_range 可為任何支援 in / min / max 的整數集合 (range、frozenset 等)
     while True:
         try:
             raw = input(prompt)
@@ -145,20 +324,80 @@ def safe_input(prompt, value_type=str, valid_range=None, allow_cancel=True):
             print("\n已取消操作。")
             return None
 
+class LineStampFormatter(logging.Formatter):
+    # 一次寫入多行 (批次記錄) 時，每一行都加上時間戳記，格式與逐筆寫入相同
+    def format(self, record):
+        prefix = f"{self.formatTime(record)} - "
+        return prefix + record.getMessage().replace("\n", "\n" + prefix)
+
+_LOGGER_CACHE = {}  # (name, log_file) -> logger，避免重複建立 Engine 時開啟多餘的檔案 handler
+
 def setup_logger(name, log_file, level=logging.INFO):
+    key = (name, log_file)
+    logger = _LOGGER_CACHE.get(key)
+    if logger: return logger
+
     if not os.path.exists(LOG_DIR):
         os.makedirs(LOG_DIR)
     
-    formatter = logging.Formatter('%(asctime)s - %(message)s')
-    handler = RotatingFileHandler(log_file, maxBytes=MAX_LOG_SIZE, backupCount=BACKUP_COUNT)
-    handler.setFormatter(formatter)
-
     logger = logging.getLogger(name)
     logger.setLevel(level)
     if not logger.handlers:
+        handler = RotatingFileHandler(log_file, maxBytes=MAX_LOG_SIZE, backupCount=BACKUP_COUNT, encoding='utf-8')
+        handler.setFormatter(LineStampFormatter())
         logger.addHandler(handler)
+    _LOGGER_CACHE[key] = logger
     return logger
 
+@contextlib.contextmanager
+def atomic_open(path, compress=False):
+    # 先寫入暫存檔再以 os.replace 一次取代，避免寫入中途中斷導致檔案截斷。
+    # 暫存檔名由 mkstemp 產生，排程 (cron) 與互動選單同時寫入時不會共用同一個暫存檔
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or '.', prefix=os.path.basename(path) + '.', suffix='.tmp')
+    try:
+        with open(fd, 'wb') as raw:
+            stream = gzip.GzipFile(fileobj=raw, mode='wb') if compress else raw
+            f = TextIOWrapper(stream, encoding='utf-8')
+            yield f
+            f.flush()
+            f.detach()
+            if compress: stream.close()  # 寫入 gzip 結尾，不會關閉底層檔案
+            # 取代前確保內容已落盤
+            raw.flush()
+            os.fsync(raw.fileno())
+        # mkstemp 建立的檔案權限為 0600；已有舊檔時沿用其權限
+        try: os.chmod(tmp, stat.S_IMODE(os.stat(path).st_mode))
+        except FileNotFoundError: pass
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp): os.remove(tmp)
+        raise
+
+def load_json_file(path, default=None):
+    # 一次讀入並解析 JSON 檔；檔案不存在時回傳預設值，內容毀損時提示後回傳預設值。
+    # 狀態檔以 gzip 壓縮儲存，依 magic bytes 自動判斷，同時相容舊版未壓縮的檔案
+    try:
+        with open(path, 'rb') as f:
+            raw = f.read()
+        if raw[:2] == b'\x1f\x8b': raw = gzip.decompress(raw)
+        return _json_loads(raw)
+    except FileNotFoundError:
+        return default
+    except (OSError, EOFError, ValueError, zlib.error) as e:
+        print(f"{Colors.WARNING}無法讀取 {path}，將使用預設值: {e}{Colors.ENDC}")
+        return default
+
+@functools.lru_cache(maxsize=8192)
+def _parse_ts(ts):
+    # 歷史紀錄的時間戳記在多條規則與多個週期間重複出現，快取解析結果以避免重複 strptime；
+    # lru_cache 會淘汰最久未使用的項目，長時間執行也不會無限成長
+    for fmt in TS_FORMATS:
+        try:
+            return datetime.datetime.strptime(ts, fmt).replace(tzinfo=datetime.timezone.utc)
+        except ValueError:
+            continue
+    raise ValueError(f"無法解析的時間格式: {ts}")
+
 # ================= 設定管理 =================
 class ConfigManager:
     def __init__(self):
@@ -176,24 +415,54 @@ class ConfigManager:
             },
             "rules": []
         }
+        self._rule_types = None  # 已設定的規則類型快取，規則異動時清除
+        self._tx_depth = 0       # transaction() 巢狀層數
+        self._dirty = False      # transaction() 期間是否有待寫入的變更
         self.load()
 
     def load(self):
-        if os.path.exists(CONFIG_FILE):
-            try:
-                with open(CONFIG_FILE, 'r') as f:
-                    data = json.load(f)
-                    if "sender" not in data.get("email", {}):
-                         if "email" not in data: data["email"] = {}
-                         data["email"]["sender"] = "illumio-monitor@localhost"
-                    self.config.update(data)
-            except: pass
+        data = load_json_file(CONFIG_FILE)
+        if not isinstance(data, dict): return
+        if "sender" not in data.get("email", {}):
+             if "email" not in data: data["email"] = {}
+             data["email"]["sender"] = "illumio-monitor@localhost"
+        self.config.update(data)
+        self._rule_types = None
 
     def save(self):
-        with open(CONFIG_FILE, 'w') as f:
-            json.dump(self.config, f, indent=4)
+        if self._tx_depth:
+            self._dirty = True
+            return
+        self._dirty = False
+        # 直接串流寫入暫存檔；中文規則名稱以 UTF-8 原文保存，不轉為 \uXXXX 跳脫序列
+        with atomic_open(CONFIG_FILE) as f:
+            json.dump(self.config, f, indent=4, ensure_ascii=False)
         print(f"{Colors.GREEN}設定已儲存。{Colors.ENDC}")
 
+    @contextlib.contextmanager
+    def transaction(self):
+        # 區塊內的多次 save() 合併為離開時的一次寫入；
+        # 區塊發生例外時將設定還原為進入前的內容，未完成的修改不會被之後的 save() 寫入
+        snapshot, dirty = copy.deepcopy(self.config), self._dirty
+        self._tx_depth += 1
+        try:
+            yield self
+        except BaseException:
+            self.config.clear()
+            self.config.update(snapshot)
+            self._dirty = dirty
+            self._rule_types = None
+            raise
+        finally:
+            self._tx_depth -= 1
+        if not self._tx_depth and self._dirty:
+            self.save()
+
+    def has_rules(self, rule_type):
+        if self._rule_types is None:
+            self._rule_types = frozenset(r.get("type") for r in self.config["rules"])
+        return rule_type in self._rule_types
+
     def add_event_rule(self, name, event_type, desc="", rec="", threshold_type="immediate", threshold_count=1, threshold_window=10):
         rule = {
             "id": int(datetime.datetime.now(datetime.timezone.utc).timestamp()),
@@ -208,6 +477,7 @@ class ConfigManager:
             "threshold_window": threshold_window
         }
         self.config["rules"].append(rule)
+        self._rule_types = None
         self.save()
 
     def add_traffic_rule(self, name, pd_val, port=None, src_label=None, dst_label=None, threshold_type="immediate", threshold_count=1, threshold_window=10):
@@ -232,96 +502,193 @@ class ConfigManager:
             "threshold_window": threshold_window
         }
         self.config["rules"].append(rule)
+        self._rule_types = None
         self.save()
 
     def remove_rule(self, idx):
-        if 0 <= idx < len(self.config["rules"]):
-            del self.config["rules"][idx]
+        return self.remove_rules({idx})[0] == 1
+
+    def remove_rules(self, ids):
+        # 一次過濾掉所有指定索引並只寫入一次，回傳 (已刪除數, 無效 ID 數)
+        rules = self.config["rules"]
+        valid = {i for i in ids if 0 <= i < len(rules)}
+        if valid:
+            self.config["rules"] = [r for i, r in enumerate(rules) if i not in valid]
+            self._rule_types = None
             self.save()
-            return True
-        return False
+        return len(valid), len(ids) - len(valid)
 
     def load_best_practices(self):
         print(f"{Colors.BLUE}正在載入最佳實踐規則...{Colors.ENDC}")
-        self.config["rules"] = [] 
-        for cat, events in EVENT_TEMPLATES.items():
-            for evt in events:
-                t_type = "immediate"
-                t_count = 1
-                t_win = 10
-                if "心跳" in evt['name'] or "登入" in evt['name']:
-                    t_type = "count"
-                    t_count = 3
-                    t_win = 10 
-                self.add_event_rule(evt['name'], evt['etype'], evt['desc'], evt['rec'], t_type, t_count, t_win)
-        
-        self.add_traffic_rule("大量被阻擋流量", pd_val=2, port=None, threshold_type="count", threshold_count=10, threshold_window=10)
-        self.add_traffic_rule("潛在阻擋流量", pd_val=1, port=None, threshold_type="count", threshold_count=10, threshold_window=10)
+        with self.transaction():
+            self.config["rules"] = [] 
+            self._rule_types = None
+            for cat, events in EVENT_TEMPLATES.items():
+                for evt in events:
+                    t_type = "immediate"
+                    t_count = 1
+                    t_win = 10
+                    if "心跳" in evt['name'] or "登入" in evt['name']:
+                        t_type = "count"
+                        t_count = 3
+                        t_win = 10 
+                    self.add_event_rule(evt['name'], evt['etype'], evt['desc'], evt['rec'], t_type, t_count, t_win)
+            
+            self.add_traffic_rule("大量被阻擋流量", pd_val=2, port=None, threshold_type="count", threshold_count=10, threshold_window=10)
+            self.add_traffic_rule("潛在阻擋流量", pd_val=1, port=None, threshold_type="count", threshold_count=10, threshold_window=10)
         print(f"{Colors.GREEN}最佳實踐規則載入完成。{Colors.ENDC}")
 
 # ================= 監控引擎 =================
+class _DeferredPrint:
+    # 背景執行緒的進度輸出先暫存，待 release() 後依序印出並改為即時輸出，避免與主執行緒輸出交錯
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buf = []
+        self._live = False
+
+    def __call__(self, *args, **kwargs):
+        with self._lock:
+            if not self._live:
+                self._buf.append((args, kwargs))
+                return
+        print(*args, **kwargs)
+
+    def release(self):
+        with self._lock:
+            self._live = True
+            for args, kwargs in self._buf: print(*args, **kwargs)
+            self._buf = []
+
 class ApiMonitorEngine:
     def __init__(self, config_manager):
         self.cm = config_manager
         self.api_cfg = self.cm.config["api"]
         self.base_url = f"{self.api_cfg['url']}/api/v2/orgs/{self.api_cfg['org_id']}"
         self.auth = HTTPBasicAuth(self.api_cfg['key'], self.api_cfg['secret'])
+        # 共用 Session 以重複使用 TCP/TLS 連線 (Job 輪詢會連續呼叫多次)；重試由 _http_request 處理
+        self.session = requests.Session()
+        self.session.auth = self.auth
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=8)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self._host_block_until = {}  # 依主機 (netloc) 記錄限流解除時間
+        self._host_lock = threading.Lock()
+        self._stop = threading.Event()  # 中斷 (Ctrl-C) 時通知背景流量輪詢提前結束
         
-        self.health_alerts = []  # 儲存健康檢查異常
-        self.event_alerts = []
-        self.traffic_alerts = []
+        self.reset_alerts()
         
         self.event_logger = setup_logger('illumio_events', EVENT_LOG_FILE)
         self.traffic_logger = setup_logger('illumio_traffic', TRAFFIC_LOG_FILE)
         
         self.last_check = datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
         self.state = {"last_check": self.last_check, "history": {}}
-        
-        if os.path.exists(STATE_FILE):
-            try:
-                with open(STATE_FILE, 'r') as f:
-                    loaded = json.load(f)
-                    self.state.update(loaded)
-            except: pass
+        self.load_state()
+
+    def load_state(self):
+        # 排程 (cron) 與互動選單可能交替寫入同一份狀態檔，每次分析前重新讀取最新內容；
+        # 檔案不存在或無法讀取時保留目前的狀態
+        loaded = load_json_file(STATE_FILE)
+        if isinstance(loaded, dict): self.state.update(loaded)
+        if not isinstance(self.state.get("history"), dict): self.state["history"] = {}
+
+    def reset_alerts(self):
+        self.health_alerts = []  # 儲存健康檢查異常
+        self.event_alerts = []
+        self.traffic_alerts = []
 
     def save_state(self):
-        self.state["last_check"] = datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
         now = datetime.datetime.now(datetime.timezone.utc)
+        self.state["last_check"] = now.strftime('%Y-%m-%dT%H:%M:%SZ')
         cutoff = now - datetime.timedelta(minutes=120)
         
+        # 已刪除的規則不再保留歷史
+        active_rids = {str(r["id"]) for r in self.cm.config["rules"]}
         cleaned_history = {}
         for rid, records in self.state["history"].items():
-            valid_records = []
+            if rid not in active_rids: continue
+            # 單次走訪：過濾過期紀錄並同時合併相同時間戳記的計數
+            merged = Counter()
             for rec in records:
                 try:
                     if isinstance(rec, str): ts, c = rec, 1
                     else: ts, c = rec.get('t'), rec.get('c', 1)
-                    try:
-                        t_obj = datetime.datetime.strptime(ts, '%Y-%m-%dT%H:%M:%SZ').replace(tzinfo=datetime.timezone.utc)
-                    except ValueError:
-                        t_obj = datetime.datetime.strptime(ts, '%Y-%m-%dT%H:%M:%SZ').replace(tzinfo=datetime.timezone.utc)
-                    if t_obj > cutoff:
-                        valid_records.append({"t": ts, "c": c})
+                    if _parse_ts(ts) > cutoff:
+                        merged[ts] += c
                 except: pass
             
-            merged_map = {}
-            for r in valid_records:
-                merged_map[r['t']] = merged_map.get(r['t'], 0) + r['c']
-            
-            final_records = [{"t": k, "c": v} for k, v in merged_map.items()]
-            if final_records:
-                cleaned_history[rid] = final_records
+            if merged:
+                cleaned_history[rid] = [{"t": k, "c": v} for k, v in merged.items()]
         
         self.state["history"] = cleaned_history
-        with open(STATE_FILE, 'w') as f:
+        with atomic_open(STATE_FILE, compress=True) as f:
             json.dump(self.state, f)
 
+    def _retry_delay(self, headers, attempt):
+        # 優先採用 PCE 回傳的 Retry-After (秒數或 HTTP 日期)，否則使用指數退避 + 抖動
+        retry_after = headers.get('Retry-After')
+        if retry_after:
+            try:
+                return min(max(float(retry_after), 0), HTTP_MAX_BACKOFF)
+            except ValueError:
+                try:
+                    delta = parsedate_to_datetime(retry_after) - datetime.datetime.now(datetime.timezone.utc)
+                    return min(max(delta.total_seconds(), 0), HTTP_MAX_BACKOFF)
+                except (TypeError, ValueError): pass
+        return min(HTTP_BACKOFF_BASE * 2 ** attempt + random.uniform(0, HTTP_BACKOFF_BASE), HTTP_MAX_BACKOFF)
+
+    def _update_host_limit(self, host, headers):
+        # X-RateLimit-Remaining 歸零時，在 X-RateLimit-Reset 之前暫停對該主機發送請求
+        if headers.get('X-RateLimit-Remaining') != '0': return
+        try: reset = float(headers.get('X-RateLimit-Reset', HTTP_BACKOFF_BASE))
+        except ValueError: reset = HTTP_BACKOFF_BASE
+        now = time.time()
+        wait = reset - now if reset > now else reset  # 支援 epoch 或剩餘秒數兩種格式
+        with self._host_lock:
+            self._host_block_until[host] = now + min(max(wait, 0), HTTP_MAX_BACKOFF)
+
+    def _wait_for_host(self, host):
+        with self._host_lock:
+            wait = self._host_block_until.get(host, 0) - time.time()
+        if wait > 0: time.sleep(wait)
+
+    @staticmethod
+    def _connect_failed(e):
+        # 連線階段即失敗 (逾時或被拒)，請求確定尚未送達 PCE
+        if isinstance(e, requests.exceptions.ConnectTimeout): return True
+        reason = getattr(e.args[0], 'reason', None) if e.args else None
+        return isinstance(reason, NewConnectionError)
+
+    def _http_request(self, method, url, **kwargs):
+        """對 PCE 發送 HTTP 請求，遇到連線錯誤、429 或 5xx 時自動重試。
+
+        非冪等方法僅在 429 與連線階段失敗時重試；SSL 錯誤一律不重試。
+        """
+        kwargs.setdefault('verify', self.api_cfg['verify_ssl'])
+        kwargs.setdefault('timeout', HTTP_TIMEOUT)
+        host = urlparse(url).netloc
+        idempotent = method.upper() in HTTP_IDEMPOTENT_METHODS
+        for attempt in range(HTTP_MAX_RETRIES + 1):
+            self._wait_for_host(host)
+            try:
+                r = self.session.request(method, url, **kwargs)
+            except requests.exceptions.SSLError:
+                raise
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                if attempt >= HTTP_MAX_RETRIES or not (idempotent or self._connect_failed(e)): raise
+                time.sleep(self._retry_delay({}, attempt))
+                continue
+            self._update_host_limit(host, r.headers)
+            retryable = r.status_code in HTTP_RETRY_STATUS and (idempotent or r.status_code == 429)
+            if not retryable or attempt >= HTTP_MAX_RETRIES:
+                return r
+            time.sleep(self._retry_delay(r.headers, attempt))
+
     def check_pce_health(self):
         # 根據文件，health check endpoint 是 /api/v2/health
         url = f"{self.api_cfg['url']}/api/v2/health"
         print(f"正在檢查 PCE 服務健康狀態 ({url})...")
         try:
-            r = requests.get(url, auth=self.auth, verify=self.api_cfg['verify_ssl'], timeout=10)
+            r = self._http_request("GET", url, timeout=10)
             if r.status_code != 200:
                 self.health_alerts.append({
                     "time": datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC'),
@@ -346,29 +713,30 @@ class ApiMonitorEngine:
         print(f"正在讀取事件 (自 {check_time} 起)...")
         try:
             headers = {"Accept": "application/json"}
-            r = requests.get(url, auth=self.auth, headers=headers, params=params, verify=self.api_cfg['verify_ssl'], timeout=10)
-            if r.status_code == 200: return r.json()
+            r = self._http_request("GET", url, headers=headers, params=params, timeout=10)
+            if r.status_code == 200: return _json_loads(r.content)
             return []
         except Exception as e:
             print(f"{Colors.FAIL}Event API 錯誤: {e}{Colors.ENDC}")
             return []
 
     def parse_downloaded_data(self, content):
+        # 依 gzip magic bytes 判斷是否需解壓，並以串流方式逐行解碼，
+        # 不必先將解壓後的整份內容與其字串副本載入記憶體
+        raw = gzip.GzipFile(fileobj=BytesIO(content)) if content[:2] == b'\x1f\x8b' else BytesIO(content)
         try:
-            with gzip.GzipFile(fileobj=BytesIO(content)) as f: content = f.read()
-        except: pass 
-        try: text_data = content.decode('utf-8')
-        except: return []
-        try: return json.loads(text_data)
-        except json.JSONDecodeError: pass 
-        try:
-            results = []
-            for line in text_data.splitlines():
-                if line.strip(): results.append(json.loads(line))
-            return results
+            with TextIOWrapper(raw, encoding='utf-8') as f:
+                results = []
+                for line in f:
+                    if not line.strip(): continue
+                    if not results and line.lstrip().startswith('['):
+                        # 整份內容為單一 JSON 陣列 (非 JSON Lines)
+                        return _json_loads(line + f.read())
+                    results.append(_json_loads(line))
+                return results
         except: return []
 
-    def fetch_traffic_async(self):
+    def fetch_traffic_async(self, out=print):
         query_url = f"{self.base_url}/traffic_flows/async_queries"
         now = datetime.datetime.now(datetime.timezone.utc)
         end_time = (now - datetime.timedelta(minutes=5)).strftime('%Y-%m-%dT%H:%M:%SZ')
@@ -385,146 +753,207 @@ class ApiMonitorEngine:
             "services": {"include": [], "exclude": []}
         }
         
-        print(f"正在提交流量查詢 ({start_time} 至 {end_time}) [已延遲修正]...")
+        out(f"正在提交流量查詢 ({start_time} 至 {end_time}) [已延遲修正]...")
         try:
             headers = {"Accept": "application/json", "Content-Type": "application/json"}
-            r = requests.post(query_url, auth=self.auth, headers=headers, json=payload, verify=self.api_cfg['verify_ssl'], timeout=10)
+            r = self._http_request("POST", query_url, headers=headers, json=payload, timeout=10)
             if r.status_code not in [201, 202]:
-                print(f"{Colors.WARNING}流量查詢提交失敗 ({r.status_code}): {r.text}{Colors.ENDC}")
+                out(f"{Colors.WARNING}流量查詢提交失敗 ({r.status_code}): {r.text}{Colors.ENDC}")
                 return []
             
             job_url = r.json().get("href")
-            print("等待流量計算中...", end="", flush=True)
+            out("等待流量計算中...", end="", flush=True)
             for _ in range(20): 
-                time.sleep(2)
-                status_r = requests.get(f"{self.api_cfg['url']}/api/v2{job_url}", auth=self.auth, headers=headers, verify=self.api_cfg['verify_ssl'])
+                if self._stop.wait(2): return []
+                status_r = self._http_request("GET", f"{self.api_cfg['url']}/api/v2{job_url}", headers=headers)
                 state = status_r.json().get("status")
                 if state == "completed":
-                    print(" 完成。")
+                    out(" 完成。")
                     break
                 if state == "failed":
-                    print(f" Job Failed.")
+                    out(f" Job Failed.")
                     return []
-                print(".", end="", flush=True)
+                out(".", end="", flush=True)
             else:
-                print(" 逾時。")
+                out(" 逾時。")
                 return []
 
             dl_url = f"{self.api_cfg['url']}/api/v2{job_url}/download"
-            dl_r = requests.get(dl_url, auth=self.auth, headers=headers, verify=self.api_cfg['verify_ssl'], stream=True)
+            dl_r = self._http_request("GET", dl_url, headers=headers)
             if dl_r.status_code == 204 or not dl_r.content: return []
             return self.parse_downloaded_data(dl_r.content)
         except Exception as e:
-            print(f"{Colors.FAIL}Traffic Async 錯誤: {e}{Colors.ENDC}")
+            out(f"{Colors.FAIL}Traffic Async 錯誤: {e}{Colors.ENDC}")
             return []
 
     def log_audit_data(self, events, is_traffic=False):
         logger = self.traffic_logger if is_traffic else self.event_logger
-        for e in events:
-            logger.info(json.dumps(e))
         if events:
+            # 整批組成一筆記錄寫入，只需取得一次 handler 鎖、檢查一次輪替並寫入一次
+            logger.info("\n".join(_json_dumps(e) for e in events))
             type_str = "流量 (Traffic)" if is_traffic else "系統 (System)"
             print(f"已記錄 {len(events)} 筆 {type_str} 資料至本地日誌。")
 
-    def get_traffic_details(self, flow):
-        src_ip = flow.get('src', {}).get('ip', 'N/A')
-        src_name = flow.get('src', {}).get('workload', {}).get('name') or src_ip
-        dst_ip = flow.get('dst', {}).get('ip', 'N/A')
-        dst_name = flow.get('dst', {}).get('workload', {}).get('name') or dst_ip
-        svc = flow.get('service', {})
-        port = svc.get('port', 'All')
-        proto = svc.get('proto', 'N/A')
-        return {
-            "key": f"{src_name} ({src_ip}) -> {dst_name} ({dst_ip}) [{port}/{proto}]",
-            "decision": flow.get('policy_decision', 'N/A')
-        }
+    def count_top_talkers(self, flows):
+        # 大量流量時的熱點迴圈：以區域變數綁定 dict.get，並共用唯讀空 dict，避免每筆流量額外配置
+        talkers = Counter()
+        get = dict.get
+        for flow in flows:
+            src = get(flow, 'src', _EMPTY)
+            dst = get(flow, 'dst', _EMPTY)
+            svc = get(flow, 'service', _EMPTY)
+            src_ip = get(src, 'ip', 'N/A')
+            dst_ip = get(dst, 'ip', 'N/A')
+            src_name = get(get(src, 'workload', _EMPTY), 'name') or src_ip
+            dst_name = get(get(dst, 'workload', _EMPTY), 'name') or dst_ip
+            talkers[f"{src_name} ({src_ip}) -> {dst_name} ({dst_ip}) [{get(svc, 'port', 'All')}/{get(svc, 'proto', 'N/A')}]"] += 1
+        return talkers
+
+    def parse_label_filter(self, filter_str):
+        # "key=value" -> (key, value)；未設定回傳 None，格式錯誤回傳 False (不比對任何流量)
+        if not filter_str: return None
+        if '=' not in filter_str: return False
+        fk, fv = filter_str.split('=', 1)
+        return fk.strip(), fv.strip()
 
-    def check_flow_labels(self, flow_side, filter_str):
-        if not filter_str: return True
+    def get_label_map(self, flow_side):
+        # 將 workload 標籤清單轉為 {key: value}，每筆流量只建立一次並供所有規則共用
         try:
-            fk, fv = filter_str.split('=', 1)
-            fk, fv = fk.strip(), fv.strip()
-            labels = flow_side.get('workload', {}).get('labels', [])
-            for l in labels:
-                if l.get('key') == fk and l.get('value') == fv: return True
-            return False
-        except: return False
+            labels = flow_side.get('workload', _EMPTY).get('labels') or ()
+            return {l.get('key'): l.get('value') for l in labels}
+        except: return {}
+
+    def check_flow_labels(self, label_map, label_filter):
+        if label_filter is None: return True
+        if not label_filter: return False
+        fk, fv = label_filter
+        return label_map.get(fk) == fv
+
+    def get_flow_pd(self, flow):
+        raw_pd = flow.get("pd")
+        if raw_pd is not None: return int(raw_pd)
+        raw_decision = flow.get("policy_decision")
+        if raw_decision:
+            if "potentially" in raw_decision: return 1
+            if "blocked" in raw_decision: return 2
+            if "allowed" in raw_decision: return 0
+        return -1
+
+    def match_events(self, events, tokens):
+        # 事件只走訪一次，依規則的 filter_value 分組：{filter_value: [符合的事件]}
+        matched = {t: [] for t in tokens}
+        if not matched: return matched
+        for e in events:
+            et = e.get("event_type", "")
+            notes = e.get("notifications")
+            ntypes = [n.get("notification_type", "") for n in notes] if isinstance(notes, list) else ()
+            for token, bucket in matched.items():
+                if token in et or any(token in nt for nt in ntypes): bucket.append(e)
+        return matched
+
+    def count_in_window(self, records, window_start):
+        # 歷史紀錄依時間附加 (save_state 合併時亦保持順序)，由新到舊累加，
+        # 遇到第一筆早於窗口起點的紀錄即可停止，不必解析整段歷史
+        total = 0
+        for rec in reversed(records):
+            if isinstance(rec, dict): ts, c = rec.get('t'), rec.get('c', 0)
+            else: ts, c = rec, 1
+            try:
+                if _parse_ts(ts) <= window_start: break
+            except: continue
+            total += c
+        return total
 
     def analyze(self):
+        # Engine 會在選單中重複使用，每次執行前清除上一輪的告警並重新讀取狀態檔
+        self.reset_alerts()
+        self.load_state()
+
         # 1. 先執行健康檢查
         self.check_pce_health()
 
         # 2. 執行常規分析
-        events = self.fetch_events()
-        if events: self.log_audit_data(events, is_traffic=False)
+        # 流量查詢需等待 PCE 非同步計算 (最長約 40 秒)，改於背景執行緒進行，
+        # 讓事件讀取與流量 Job 輪詢同時進行，總耗時約等於較慢的一方。
+        # 背景執行緒設為 daemon 並以 _stop 通知結束，Ctrl-C 時不必等待輪詢完成；
+        # 其進度輸出延後到事件讀取結束才印出。未設定對應類型的規則時不呼叫 API
+        events, traffic = [], []
+        has_event_rules = self.cm.has_rules('event')
+        has_traffic_rules = self.cm.has_rules('traffic')
+        traffic_result = []
+        worker = None
+        if has_traffic_rules:
+            traffic_out = _DeferredPrint()
+            self._stop.clear()
+            worker = threading.Thread(target=lambda: traffic_result.append(self.fetch_traffic_async(traffic_out)), daemon=True)
+            worker.start()
+        try:
+            if has_event_rules: events = self.fetch_events()
+            if worker:
+                traffic_out.release()
+                # 以逾時方式 join，讓主執行緒能及時收到 KeyboardInterrupt
+                while worker.is_alive(): worker.join(0.5)
+        except KeyboardInterrupt:
+            self._stop.set()
+            raise
+        if traffic_result: traffic = traffic_result[0]
 
-        traffic = []
-        has_traffic_rules = any(r['type'] == 'traffic' for r in self.cm.config['rules'])
+        if has_event_rules:
+            if events: self.log_audit_data(events, is_traffic=False)
+        else:
+            print(f"{Colors.BLUE}跳過事件查詢 (未設定事件規則)。{Colors.ENDC}")
         if has_traffic_rules:
-            traffic = self.fetch_traffic_async()
             if traffic: self.log_audit_data(traffic, is_traffic=True)
         else:
             print(f"{Colors.BLUE}跳過流量查詢 (未設定流量規則)。{Colors.ENDC}")
         
-        for rule in self.cm.config["rules"]:
+        rules = self.cm.config["rules"]
+        # 預先建立索引：事件依 filter_value 一次比對完成，流量依 Policy Decision 分組，
+        # 避免每條規則都重新掃描全部事件/流量
+        event_matches = self.match_events(events, {r["filter_value"] for r in rules if r["type"] == "event"})
+        flows_by_pd = {}
+        for f in traffic:
+            flows_by_pd.setdefault(self.get_flow_pd(f), []).append(f)
+        # 有規則使用標籤過濾時，才預先建立每筆流量來源/目的的標籤索引 (以 id(flow) 對應，不修改原始資料)
+        flow_labels = {}
+        if any(r["type"] == "traffic" and (r.get("src_label") or r.get("dst_label")) for r in rules):
+            for f in traffic:
+                flow_labels[id(f)] = (self.get_label_map(f.get('src', _EMPTY)), self.get_label_map(f.get('dst', _EMPTY)))
+
+        # 同一週期內所有規則共用同一個時間點，時間窗口起點依窗口長度只計算一次
+        now = datetime.datetime.now(datetime.timezone.utc)
+        now_str = now.strftime('%Y-%m-%dT%H:%M:%SZ')
+        window_starts = {w: now - datetime.timedelta(minutes=w) for w in {r.get("threshold_window", 10) for r in rules}}
+
+        for rule in rules:
             matches = []
             
             if rule["type"] == "event":
-                target_val = rule["filter_value"]
-                for e in events:
-                    match_found = False
-                    if target_val in e.get("event_type", ""): match_found = True
-                    elif "notifications" in e and isinstance(e["notifications"], list):
-                        for n in e["notifications"]:
-                            if target_val in n.get("notification_type", ""):
-                                match_found = True
-                                break
-                    if match_found: matches.append(e)
+                matches = event_matches[rule["filter_value"]]
 
             elif rule["type"] == "traffic":
-                target_pd = rule.get("pd", 2)
-                src_filter = rule.get("src_label")
-                dst_filter = rule.get("dst_label")
-                for f in traffic:
-                    raw_pd = f.get("pd")
-                    raw_decision = f.get("policy_decision")
-                    flow_pd = -1
-                    if raw_pd is not None: flow_pd = int(raw_pd)
-                    elif raw_decision:
-                        if "potentially" in raw_decision: flow_pd = 1
-                        elif "blocked" in raw_decision: flow_pd = 2
-                        elif "allowed" in raw_decision: flow_pd = 0
-                    
-                    if flow_pd == target_pd:
-                        is_match = True
-                        if rule["port"] and f.get("dst_port") != rule["port"]: is_match = False
-                        if is_match and src_filter:
-                            if not self.check_flow_labels(f.get('src', {}), src_filter): is_match = False
-                        if is_match and dst_filter:
-                            if not self.check_flow_labels(f.get('dst', {}), dst_filter): is_match = False
-                        if is_match: matches.append(f)
+                port = rule.get("port")
+                src_filter = self.parse_label_filter(rule.get("src_label"))
+                dst_filter = self.parse_label_filter(rule.get("dst_label"))
+                for f in flows_by_pd.get(rule.get("pd", 2), []):
+                    if port and f.get("dst_port") != port: continue
+                    if src_filter is not None or dst_filter is not None:
+                        src_labels, dst_labels = flow_labels[id(f)]
+                        if not self.check_flow_labels(src_labels, src_filter): continue
+                        if not self.check_flow_labels(dst_labels, dst_filter): continue
+                    matches.append(f)
 
             # 速率限制與紀錄
             current_count = len(matches)
             rid = str(rule["id"])
-            if rid not in self.state["history"]: self.state["history"][rid] = []
+            # 歷史筆數由 save_state 移除已刪除規則的紀錄來限制
+            history = self.state["history"]
+            if rid not in history: history[rid] = []
             
             if current_count > 0:
-                now_str = datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
-                self.state["history"][rid].append({"t": now_str, "c": current_count})
-            
-            window_minutes = rule.get("threshold_window", 10)
-            window_start = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(minutes=window_minutes)
+                history[rid].append({"t": now_str, "c": current_count})
             
-            total_count_in_window = 0
-            for rec in self.state["history"][rid]:
-                if isinstance(rec, dict): ts, c = rec.get('t'), rec.get('c', 0)
-                else: ts, c = rec, 1
-                try:
-                    t_obj = datetime.datetime.strptime(ts, '%Y-%m-%dT%H:%M:%SZ').replace(tzinfo=datetime.timezone.utc)
-                    if t_obj > window_start:
-                        total_count_in_window += c
-                except: pass
+            total_count_in_window = self.count_in_window(history[rid], window_starts[rule.get("threshold_window", 10)])
             
             trigger = False
             if rule["threshold_type"] == "immediate" and current_count > 0: trigger = True
@@ -532,25 +961,19 @@ class ApiMonitorEngine:
             
             if trigger:
                 # 擷取原始日誌 (Snapshot)
-                raw_snapshot = json.dumps(matches[:2], indent=2, default=str) if matches else "No raw data."
+                raw_snapshot = _json_dumps(matches[:2], pretty=True) if matches else "No raw data."
 
                 if rule["type"] == "traffic":
-                    talkers = Counter()
-                    for m in matches:
-                        d = self.get_traffic_details(m)
-                        talkers[d["key"]] += 1
+                    talkers = self.count_top_talkers(matches)
                     
-                    top_list = []
-                    for k, v in talkers.most_common(5):
-                        top_list.append(f"{k} [Count: {v}]")
-                    talkers_summary = "<br>".join(top_list)
+                    top_list = [f"{k} [Count: {v}]" for k, v in talkers.most_common(5)]
                     
                     self.traffic_alerts.append({
                         "rule": rule["name"],
                         "count": total_count_in_window,
                         "desc": rule.get("desc", ""),
                         "rec": rule.get("rec", ""),
-                        "details": talkers_summary,
+                        "details": top_list,
                         "raw": raw_snapshot
                     })
                 else:
@@ -590,202 +1013,195 @@ class ApiMonitorEngine:
             
         if force_test: subject = "[Illumio 監控系統] 測試郵件"
 
-        # === 1. Health Alert HTML ===
+        # 所有動態內容 (含原始日誌與 PCE 回傳內容) 一律經 HTML 跳脫後才填入範本
+        def esc(value): return html.escape(str(value), quote=False)
         health_html = ""
         if self.health_alerts:
-            rows = ""
-            for a in self.health_alerts:
-                rows += f"""
-                <tr>
-                    <td style="padding:10px; border-bottom:1px solid #eee; font-weight:bold;">{a['time']}</td>
-                    <td style="padding:10px; border-bottom:1px solid #eee; color:#dc3545; font-weight:bold;">{a['status']}</td>
-                    <td style="padding:10px; border-bottom:1px solid #eee; font-family:monospace; font-size:12px;">{a['details']}</td>
-                </tr>
-                """
-            health_html = f"""
-            <h3 style="background:#dc3545; color:white; padding:10px; margin-top:20px;">🚨 PCE 服務健康狀態異常 (Service Health Alert)</h3>
-            <div style="padding:10px; background:#fff3f3; border:1px solid #dc3545; color:#dc3545; margin-bottom:15px;">
-                <strong>警告：</strong> 無法連線至 PCE API ({self.api_cfg['url']})，請立即檢查系統狀態。
-            </div>
-            <table style="width:100%; border-collapse:collapse; font-family:Arial, sans-serif;">
-                <tr style="background:#f7f7f7;">
-                    <th style="text-align:left; padding:8px;">時間 (UTC)</th>
-                    <th style="text-align:left; padding:8px;">狀態 (Status)</th>
-                    <th style="text-align:left; padding:8px;">錯誤詳情 (Details)</th>
-                </tr>
-                {rows}
-            </table>
-            """
+            rows = "".join(HEALTH_ROW_HTML.substitute(
+                time=esc(a['time']), status=esc(a['status']), details=esc(a['details'])
+            ) for a in self.health_alerts)
+            health_html = HEALTH_SECTION_HTML.substitute(url=esc(self.api_cfg['url']), rows=rows)
 
-        # === 2. Event Alert HTML ===
         event_html = ""
         if self.event_alerts:
-            rows = ""
-            for a in self.event_alerts:
-                sev_color = "#dc3545" if a['severity'] == 'error' else "#ffc107"
-                raw_block = f"""
-                <tr>
-                    <td colspan="5" style="padding:10px; background:#f8f9fa; border-bottom:1px solid #eee;">
-                        <div style="font-size:11px; color:#555; font-family:monospace; margin-bottom:5px;"><strong>原始日誌快照 (Raw Log Snapshot):</strong></div>
-                        <pre style="margin:0; font-size:10px; color:#333; white-space:pre-wrap; background:#eee; padding:5px;">{a.get('raw', 'N/A')}</pre>
-                    </td>
-                </tr>
-                """
-                rows += f"""
-                <tr>
-                    <td style="padding:8px; border-bottom:1px solid #eee;">{a['time']}</td>
-                    <td style="padding:8px; border-bottom:1px solid #eee;">{a['rule']}</td>
-                    <td style="padding:8px; border-bottom:1px solid #eee; color:{sev_color}; font-weight:bold;">{a['severity'].upper()} ({a['count']})</td>
-                    <td style="padding:8px; border-bottom:1px solid #eee;">{a['source']}</td>
-                    <td style="padding:8px; border-bottom:1px solid #eee; font-size:12px;">
-                        <div>{a['desc']}</div>
-                        <div style="color:#666;">Type: {a['raw_type']}</div>
-                        <div style="color:#0056b3;"><strong>建議:</strong> {a['rec']}</div>
-                    </td>
-                </tr>
-                {raw_block}
-                """
-            event_html = f"""
-            <h3 style="background:#f0ad4e; color:white; padding:10px; margin-top:20px;">安全性與系統事件 (Security Events)</h3>
-            <table style="width:100%; border-collapse:collapse; font-family:Arial, sans-serif;">
-                <tr style="background:#f7f7f7;">
-                    <th style="text-align:left; padding:8px;">時間</th>
-                    <th style="text-align:left; padding:8px;">規則</th>
-                    <th style="text-align:left; padding:8px;">嚴重性 (次數)</th>
-                    <th style="text-align:left; padding:8px;">來源</th>
-                    <th style="text-align:left; padding:8px;">詳細資訊與建議</th>
-                </tr>
-                {rows}
-            </table>
-            """
+            rows = "".join(EVENT_ROW_HTML.substitute(
+                time=esc(a['time']), rule=esc(a['rule']),
+                sev_color="#dc3545" if a['severity'] == 'error' else "#ffc107",
+                severity=esc(str(a['severity']).upper()), count=a['count'], source=esc(a['source']),
+                desc=esc(a['desc']), raw_type=esc(a['raw_type']), rec=esc(a['rec']),
+                raw=esc(a.get('raw', 'N/A'))
+            ) for a in self.event_alerts)
+            event_html = EVENT_SECTION_HTML.substitute(rows=rows)
 
-        # === 3. Traffic Alert HTML ===
         traffic_html = ""
         if self.traffic_alerts:
-            rows = ""
-            for a in self.traffic_alerts:
-                raw_block = f"""
-                <tr>
-                    <td colspan="4" style="padding:10px; background:#f8f9fa; border-bottom:1px solid #eee;">
-                        <div style="font-size:11px; color:#555; font-family:monospace; margin-bottom:5px;"><strong>原始日誌快照 (Raw Log Snapshot):</strong></div>
-                        <pre style="margin:0; font-size:10px; color:#333; white-space:pre-wrap; background:#eee; padding:5px;">{a.get('raw', 'N/A')}</pre>
-                    </td>
-                </tr>
-                """
-                rows += f"""
-                <tr>
-                    <td style="padding:8px; border-bottom:1px solid #eee; font-weight:bold; color:#d9534f;">{a['count']}</td>
-                    <td style="padding:8px; border-bottom:1px solid #eee;">{a['rule']}</td>
-                    <td style="padding:8px; border-bottom:1px solid #eee; font-size:12px;">{a['details']}</td>
-                    <td style="padding:8px; border-bottom:1px solid #eee; font-size:12px; color:#0056b3;">
-                        {a['rec']}
-                    </td>
-                </tr>
-                {raw_block}
-                """
-            traffic_html = f"""
-            <h3 style="background:#17a2b8; color:white; padding:10px; margin-top:20px;">流量異常 (Traffic Anomalies)</h3>
-            <table style="width:100%; border-collapse:collapse; font-family:Arial, sans-serif;">
-                <tr style="background:#f7f7f7;">
-                    <th style="text-align:left; padding:8px;">累積次數</th>
-                    <th style="text-align:left; padding:8px;">規則</th>
-                    <th style="text-align:left; padding:8px;">前 5 名流量來源 (Top Talkers)</th>
-                    <th style="text-align:left; padding:8px;">建議措施</th>
-                </tr>
-                {rows}
-            </table>
-            """
+            rows = "".join(TRAFFIC_ROW_HTML.substitute(
+                count=a['count'], rule=esc(a['rule']),
+                details="<br>".join(esc(d) for d in a['details']), rec=esc(a['rec']),
+                raw=esc(a.get('raw', 'N/A'))
+            ) for a in self.traffic_alerts)
+            traffic_html = TRAFFIC_SECTION_HTML.substitute(rows=rows)
 
-        full_body = f"""
-        <html>
-        <body style="font-family: Arial, sans-serif; color:#333;">
-            <div style="max-width:900px; margin:auto; border:1px solid #ddd; padding:20px;">
-                <h2 style="color:#2c3e50; text-align:center;">Illumio API 監控報告</h2>
-                <div style="text-align:center; color:#777; font-size:12px; margin-bottom:20px;">
-                    Org ID: {self.cm.config['api']['org_id']} | 產生時間: {datetime.datetime.now(datetime.timezone.utc).isoformat()}
-                </div>
-                {health_html}
-                {event_html}
-                {traffic_html}
-                <div style="margin-top:30px; font-size:11px; color:#999; text-align:center; border-top:1px solid #eee; padding-top:10px;">
-                    這是自動產生的郵件，請登入 PCE Console 查看完整日誌。
-                </div>
-            </div>
-        </body>
-        </html>
-        """
+        full_body = REPORT_HTML.substitute(
+            org_id=esc(self.cm.config['api']['org_id']),
+            now=datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            health_html=health_html, event_html=event_html, traffic_html=traffic_html
+        )
         
-        msg = MIMEMultipart()
+        msg = EmailMessage()
         msg['Subject'] = subject
         msg['From'] = cfg['sender']
         msg['To'] = ", ".join(cfg['recipients'])
-        msg.attach(MIMEText(full_body, 'html'))
+        msg.set_content("此告警信件為 HTML 格式，請使用支援 HTML 的郵件用戶端檢視。")
+        msg.add_alternative(full_body, subtype='html')
         
         try:
             with smtplib.SMTP('localhost') as s:
-                s.sendmail(cfg['sender'], cfg['recipients'], msg.as_string())
+                s.send_message(msg)
             print(f"{Colors.GREEN}郵件發送成功。{Colors.ENDC}")
         except Exception as e:
             print(f"{Colors.FAIL}郵件發送失敗: {e}{Colors.ENDC}")
 
 # ================= UI Logic =================
+# 選單中固定不變的部分 (含色碼) 於載入時組好並預先編碼，重繪時只需組合動態資訊
+_WARN_TRAFFIC_RULE = f"{Colors.WARNING}流量規則{Colors.ENDC}"
+_CYAN_BEST_PRACTICES = f"{Colors.CYAN}5. 載入官方最佳實踐 (Best Practices){Colors.ENDC}"
+_WARN_DEBUG_MODE = f"{Colors.WARNING}8. 除錯模式: 查看原始 API 回傳{Colors.ENDC}"
+_WARN_TRAFFIC_TITLE = f"{Colors.WARNING}流量告警設定{Colors.ENDC}"
+_MSG_ALERT_SENT = f"{Colors.FAIL}偵測到異常！告警信件已發送。{Colors.ENDC}"
+_MSG_ALL_CLEAR = f"{Colors.GREEN}系統正常，無新增異常。{Colors.ENDC}"
+
+_MAIN_MENU_TITLE = f"{Colors.HEADER}=== Illumio API 監控系統 ==={Colors.ENDC}\n"
+_MAIN_MENU_BODY = "\n".join([
+    "-" * 40,
+    "1. 新增事件規則 (Event Rule)",
+    f"2. 新增{_WARN_TRAFFIC_RULE} (Traffic Rule)",
+    "3. 管理規則 (查看/刪除)",
+    "4. 系統設定 (API / Email)",
+    _CYAN_BEST_PRACTICES,
+    "6. 發送測試信件",
+    "7. 立即執行監控 (Run Once)",
+    _WARN_DEBUG_MODE,
+    "0. 離開",
+]) + "\n"
+
+_SETTINGS_MENU_TITLE = f"{Colors.HEADER}=== 系統設定 ==={Colors.ENDC}\n"
+_SETTINGS_MENU_BODY = "\n".join([
+    "-" * 30,
+    "1. 設定 API 憑證 (URL, Key, Secret)",
+    "2. 設定 Email (寄件人 / 收件人)",
+    "3. 切換 SSL 驗證開關",
+    "0. 返回主選單",
+]) + "\n"
+
+_TRAFFIC_MENU = "\n".join([
+    f"\n{_WARN_TRAFFIC_TITLE}",
+    "1. 阻擋流量 (Blocked, PD=2)",
+    "2. 潛在阻擋 (Potentially Blocked, PD=1)",
+    "0. 取消",
+]) + "\n"
+
+# 以目前終端機的編碼預先轉成 bytes，重繪時直接寫入底層 buffer，略過每次的文字編碼
+_STDOUT_ENCODING = getattr(sys.stdout, 'encoding', None) or 'utf-8'
+_MENU_BYTES = {text: text.encode(_STDOUT_ENCODING, errors='replace')
+               for text in (_MAIN_MENU_BODY, _SETTINGS_MENU_BODY, _TRAFFIC_MENU)}
+
+def _write_menu(dynamic, static):
+    # 先輸出動態文字並 flush，確保順序正確後再寫入預先編碼的固定內容
+    buf = getattr(sys.stdout, 'buffer', None)
+    if buf is None:
+        sys.stdout.write(dynamic + static)
+        sys.stdout.flush()
+        return
+    if dynamic: sys.stdout.write(dynamic)
+    sys.stdout.flush()
+    buf.write(_MENU_BYTES[static])
+    buf.flush()
+
+# 選單可選項目 (固定不變，避免每次重繪重新建立)
+_MENU_CHOICES = frozenset(range(0, 9))
+_SETTINGS_CHOICES = frozenset(range(0, 4))
+_CATEGORY_CHOICES = frozenset(range(0, len(EVENT_TEMPLATES) + 1))
+_PD_CHOICES = frozenset(range(0, 3))
+_YESNO = frozenset((1, 2))
+
+# 規則刪除 ID：整段輸入須為以逗號或空白分隔的整數，否則視為無效；負數由 remove_rules 計為不存在
+_ID_LIST_RE = re.compile(r'-?\d+(?:\s*[,\s]\s*-?\d+)*')
+_ID_RE = re.compile(r'-?\d+')
+
+_SSL_ON = f"{Colors.GREEN}True{Colors.ENDC}"
+_SSL_OFF = f"{Colors.FAIL}False (不安全){Colors.ENDC}"
+
+def _ask_threshold(default_count=5, default_window=10):
+    # 事件與流量規則共用的觸發條件提示，回傳 (類型, 次數, 時間窗口)
+    print("\n觸發條件:")
+    print("1. 立即告警 (Immediate)")
+    print("2. 累計次數 (Threshold)")
+    if safe_input("選擇: ", int, _YESNO) != 2:
+        return "immediate", 1, 10
+    tcount = safe_input(f"累積次數 (例如: {default_count}): ", int) or default_count
+    twindow = safe_input(f"時間窗口分鐘數 (例如: 5, 10) [預設: {default_window}]: ", int) or default_window
+    return "count", tcount, twindow
+
 def settings_menu(cm):
+    # 回傳 API 連線設定是否有變更，供主選單判斷是否需重建監控引擎
+    api_changed = False
     while True:
-        os.system('cls' if os.name == 'nt' else 'clear')
-        print(f"{Colors.HEADER}=== 系統設定 ==={Colors.ENDC}")
-        print(f"API URL: {cm.config['api']['url']}")
-        print(f"寄件人: {Colors.CYAN}{cm.config['email']['sender']}{Colors.ENDC}")
+        clear_screen()
         rcpt_str = ", ".join(cm.config['email']['recipients'])
-        print(f"收件人: {Colors.CYAN}{rcpt_str}{Colors.ENDC}")
-        ssl_state = f"{Colors.GREEN}True{Colors.ENDC}" if cm.config['api']['verify_ssl'] else f"{Colors.FAIL}False (不安全){Colors.ENDC}"
-        print(f"SSL 驗證: {ssl_state}")
-        print("-" * 30)
-        print("1. 設定 API 憑證 (URL, Key, Secret)")
-        print("2. 設定 Email (寄件人 / 收件人)")
-        print("3. 切換 SSL 驗證開關")
-        print("0. 返回主選單")
+        ssl_state = _SSL_ON if cm.config['api']['verify_ssl'] else _SSL_OFF
+        _write_menu(
+            _SETTINGS_MENU_TITLE +
+            f"API URL: {cm.config['api']['url']}\n"
+            f"寄件人: {Colors.CYAN}{cm.config['email']['sender']}{Colors.ENDC}\n"
+            f"收件人: {Colors.CYAN}{rcpt_str}{Colors.ENDC}\n"
+            f"SSL 驗證: {ssl_state}\n",
+            _SETTINGS_MENU_BODY
+        )
         
-        sel = safe_input("\n請選擇功能: ", int, range(0, 4))
+        sel = safe_input("\n請選擇功能: ", int, _SETTINGS_CHOICES)
         if sel is None: continue
         if sel == 0: break
         
         if sel == 1:
-            cm.config['api']['url'] = safe_input("PCE URL (例如: https://pce.company.com:8443) [按 Enter 保留]: ") or cm.config['api']['url']
-            cm.config['api']['org_id'] = safe_input("Org ID (例如: 1) [按 Enter 保留]: ") or cm.config['api']['org_id']
-            cm.config['api']['key'] = safe_input("API Key (例如: api_v1_...) [按 Enter 保留]: ") or cm.config['api']['key']
-            cm.config['api']['secret'] = safe_input("API Secret [按 Enter 保留]: ") or cm.config['api']['secret']
-            cm.save()
+            api_changed = True
+            with cm.transaction():
+                cm.config['api']['url'] = safe_input("PCE URL (例如: https://pce.company.com:8443) [按 Enter 保留]: ") or cm.config['api']['url']
+                cm.config['api']['org_id'] = safe_input("Org ID (例如: 1) [按 Enter 保留]: ") or cm.config['api']['org_id']
+                cm.config['api']['key'] = safe_input("API Key (例如: api_v1_...) [按 Enter 保留]: ") or cm.config['api']['key']
+                cm.config['api']['secret'] = safe_input("API Secret [按 Enter 保留]: ") or cm.config['api']['secret']
+                cm.save()
         elif sel == 2:
-            val = safe_input(f"新寄件人信箱 (目前: {cm.config['email']['sender']}): ")
-            if val: cm.config['email']['sender'] = val
-            rcpt_raw = safe_input("收件人 (多組請用逗號分隔): ")
-            if rcpt_raw:
-                cm.config['email']['recipients'] = [x.strip() for x in rcpt_raw.split(',') if x.strip()]
-            cm.save()
+            with cm.transaction():
+                val = safe_input(f"新寄件人信箱 (目前: {cm.config['email']['sender']}): ")
+                if val: cm.config['email']['sender'] = val
+                rcpt_raw = safe_input("收件人 (多組請用逗號分隔): ")
+                if rcpt_raw:
+                    cm.config['email']['recipients'] = [x.strip() for x in rcpt_raw.split(',') if x.strip()]
+                cm.save()
         elif sel == 3:
+            api_changed = True
             cm.config['api']['verify_ssl'] = not cm.config['api']['verify_ssl']
             cm.save()
             print(f"SSL 驗證已變更為: {cm.config['api']['verify_ssl']}")
             input("按 Enter 繼續...")
+    return api_changed
 
 def main_menu():
     cm = ConfigManager()
+    # 監控引擎 (含 HTTP Session 連線池) 在選單操作間共用，API 設定變更時才重建
+    eng = None
+    def _engine():
+        nonlocal eng
+        if eng is None: eng = ApiMonitorEngine(cm)
+        return eng
+
     while True:
-        os.system('cls' if os.name == 'nt' else 'clear')
-        print(f"{Colors.HEADER}=== Illumio API 監控系統 ==={Colors.ENDC}")
-        print(f"監控規則數: {len(cm.config['rules'])} | Org ID: {cm.config['api']['org_id']}")
-        print("-" * 40)
-        print("1. 新增事件規則 (Event Rule)")
-        print(f"2. 新增{Colors.WARNING}流量規則{Colors.ENDC} (Traffic Rule)")
-        print("3. 管理規則 (查看/刪除)")
-        print("4. 系統設定 (API / Email)")
-        print(f"{Colors.CYAN}5. 載入官方最佳實踐 (Best Practices){Colors.ENDC}")
-        print("6. 發送測試信件")
-        print("7. 立即執行監控 (Run Once)")
-        print(f"{Colors.WARNING}8. 除錯模式: 查看原始 API 回傳{Colors.ENDC}")
-        print("0. 離開")
+        clear_screen()
+        header = f"監控規則數: {len(cm.config['rules'])} | Org ID: {cm.config['api']['org_id']}\n"
+        _write_menu(_MAIN_MENU_TITLE + header, _MAIN_MENU_BODY)
         
-        sel = safe_input("\n請選擇功能: ", int, range(0, 9))
+        sel = safe_input("\n請選擇功能: ", int, _MENU_CHOICES)
         if sel is None: continue
         if sel == 0: break
         
@@ -794,7 +1210,7 @@ def main_menu():
             print("\n請選擇事件類別:")
             for i, c in enumerate(cats): print(f"{i+1}. {c}")
             print("0. 取消")
-            ci = safe_input("選擇: ", int, range(0, len(cats)+1))
+            ci = safe_input("選擇: ", int, _CATEGORY_CHOICES)
             if not ci or ci == 0: continue
             
             evts = EVENT_TEMPLATES[cats[ci-1]]
@@ -805,26 +1221,15 @@ def main_menu():
             if not ei or ei == 0: continue
             
             target = evts[ei-1]
-            print("\n觸發條件:")
-            print("1. 立即告警 (Immediate)")
-            print("2. 累計次數 (Threshold)")
-            ti = safe_input("選擇: ", int, range(1, 3))
-            ttype, tcount, twindow = "immediate", 1, 10
-            if ti == 2:
-                ttype = "count"
-                tcount = safe_input("累積次數 (例如: 5): ", int) or 5
-                twindow = safe_input("時間窗口分鐘數 (例如: 10) [預設: 10]: ", int) or 10
+            ttype, tcount, twindow = _ask_threshold()
             
             cm.add_event_rule(target['name'], target['etype'], target['desc'], target['rec'], ttype, tcount, twindow)
             print("規則已新增。")
             input("按 Enter 繼續...")
 
         elif sel == 2:
-            print(f"\n{Colors.WARNING}流量告警設定{Colors.ENDC}")
-            print("1. 阻擋流量 (Blocked, PD=2)")
-            print("2. 潛在阻擋 (Potentially Blocked, PD=1)")
-            print("0. 取消")
-            pi = safe_input("選擇: ", int, range(0, 3))
+            _write_menu("", _TRAFFIC_MENU)
+            pi = safe_input("選擇: ", int, _PD_CHOICES)
             if not pi or pi == 0: continue
             
             pd_val = 2 if pi == 1 else 1
@@ -837,77 +1242,63 @@ def main_menu():
             
             if port_in: rule_name += f" [Port:{port_in}]"
             
-            print("\n觸發條件:")
-            print("1. 立即告警")
-            print("2. 累計次數")
-            ti = safe_input("選擇: ", int, range(1, 3))
-            ttype, tcount, twindow = "immediate", 1, 10
-            if ti == 2:
-                ttype = "count"
-                tcount = safe_input("累積次數 (例如: 10): ", int) or 10
-                twindow = safe_input("時間窗口分鐘數 (例如: 5, 10) [預設: 10]: ", int) or 10
+            ttype, tcount, twindow = _ask_threshold(default_count=10)
             
             cm.add_traffic_rule(rule_name, pd_val, port_in, src_in, dst_in, ttype, tcount, twindow)
             print("流量規則已新增。")
             input("按 Enter 繼續...")
 
         elif sel == 3:
-            print("\n目前的規則列表:")
-            print(f"{'ID':<4} {'名稱':<35} {'觸發條件'}")
-            print("-" * 80)
+            # 整張規則表組成一個字串後一次輸出
+            rows = ["\n目前的規則列表:", f"{'ID':<4} {'名稱':<35} {'觸發條件'}", "-" * 80]
+            append = rows.append
             for i, r in enumerate(cm.config['rules']):
                 cond = "立即"
                 if r['threshold_type'] == 'count':
                     win = r.get('threshold_window', 10)
                     cond = f">= {r['threshold_count']}次 / {win}分"
-                print(f"{i:<4} {r['name'][:35]:<35} {cond}")
-            
-            print("\n輸入刪除 ID (支援多組如 1,3)，輸入 -1 取消。")
+                append(f"{i:<4} {r['name'][:35]:<35} {cond}")
+            append("\n輸入刪除 ID (支援多組如 1,3)，輸入 -1 取消。")
+            print("\n".join(rows))
             raw_del = input("刪除 ID: ").strip()
             
             if raw_del and raw_del != '-1':
-                try:
-                    ids_to_del = sorted([int(x.strip()) for x in raw_del.split(',') if x.strip().isdigit()], reverse=True)
-                    if not ids_to_del:
-                        print("無效的 ID。")
-                    else:
-                        for idx in ids_to_del:
-                            if cm.remove_rule(idx):
-                                print(f"已刪除規則 ID {idx}")
-                            else:
-                                print(f"刪除失敗 ID {idx}")
-                except:
-                    print("輸入格式錯誤。")
+                if not _ID_LIST_RE.fullmatch(raw_del):
+                    print("無效的 ID。")
+                else:
+                    ids_to_del = {int(x) for x in _ID_RE.findall(raw_del)}
+                    removed, missing = cm.remove_rules(ids_to_del)
+                    print(f"已刪除 {removed} 條規則" + (f"，{missing} 個 ID 不存在" if missing else "") + "。")
             
             input("按 Enter 繼續...")
 
         elif sel == 4:
-            settings_menu(cm)
+            if settings_menu(cm): eng = None
 
         elif sel == 5:
             cm.load_best_practices()
             input("最佳實踐載入完成。按 Enter 繼續...")
 
         elif sel == 6:
-            eng = ApiMonitorEngine(cm)
+            eng = _engine()
+            eng.reset_alerts()
             eng.send_email(force_test=True)
             input("測試信已發送。按 Enter 繼續...")
 
         elif sel == 7:
             if not cm.config['api']['key']: print("錯誤: 尚未設定 API Key！"); input(); continue
-            eng = ApiMonitorEngine(cm)
+            eng = _engine()
             eng.analyze()
             if eng.health_alerts or eng.event_alerts or eng.traffic_alerts:
-                print(f"{Colors.FAIL}偵測到異常！告警信件已發送。{Colors.ENDC}")
+                print(_MSG_ALERT_SENT)
                 eng.send_email()
             else:
-                print(f"{Colors.GREEN}系統正常，無新增異常。{Colors.ENDC}")
+                print(_MSG_ALL_CLEAR)
             input("按 Enter 繼續...")
 
         elif sel == 8:
             if not cm.config['api']['key']: print("請先設定 API 憑證。"); input(); continue
-            eng = ApiMonitorEngine(cm)
-            eng.dump_raw_events()
+            _engine().dump_raw_events()
             input("按 Enter 繼續...")
 
         elif sel == 0: